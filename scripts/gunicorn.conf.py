@@ -0,0 +1,10 @@
+"""
+Gunicorn configuration for the SAE inference microservice
+Run from the scripts/ directory: gunicorn sae_inference_service:app
+"""
+
+import multiprocessing
+
+bind = "0.0.0.0:5000"
+workers = multiprocessing.cpu_count()
+worker_class = "sync"
@@ -6,10 +6,16 @@ Lightweight Python service for authentic sparse autoencoder inference
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from cachetools import LRUCache
 import numpy as np
+import orjson
+import hashlib
 import json
 import logging
-from typing import Dict, List, Any, Optional
+import os
+import threading
+from functools import lru_cache
+from typing import Dict, List, Any, NamedTuple, Optional
 
 app = Flask(__name__)
 CORS(app)
@@ -18,6 +24,96 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def ojsonify(obj: Any, status: int = 200):
+    """jsonify replacement using orjson, which also serializes NumPy scalars and arrays"""
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype='application/json'
+    )
+
+# Simulated feature groups; feature ids map onto them by feature_id % _NUM_FEATURE_GROUPS
+_FEATURE_DESCRIPTIONS = (
+    "Emotional expression (positive sentiment)",
+    "Geographic locations and place names",
+    "Mathematical operations and numbers",
+    "Past tense verbs and temporal expressions",
+    "Question formation and interrogative patterns",
+    "Proper nouns and named entities",
+    "Scientific terminology and concepts",
+    "Social interaction and relationship terms",
+    "Abstract reasoning and logic patterns",
+    "Creative and artistic language"
+)
+
+_TOP_TOKENS = (
+    ("happy", "joy", "excited", "wonderful", "amazing"),
+    ("Paris", "London", "Tokyo", "mountain", "river"),
+    ("plus", "minus", "equals", "calculate", "number"),
+    ("walked", "went", "happened", "was", "did"),
+    ("what", "how", "when", "where", "why"),
+    ("John", "Mary", "Smith", "Company", "University"),
+    ("molecule", "theory", "experiment", "research", "data"),
+    ("friend", "family", "together", "relationship", "team"),
+    ("because", "therefore", "if", "then", "logic"),
+    ("create", "imagine", "beautiful", "art", "design")
+)
+
+_EXAMPLE_PROMPTS = (
+    ("I'm feeling great today!", "What a wonderful surprise!"),
+    ("The capital of France is", "Mountains are tall and"),
+    ("2 + 2 equals", "Calculate the sum of"),
+    ("Yesterday I walked to", "The event happened when"),
+    ("What is the meaning of", "How do you solve"),
+    ("Dr. Smith published", "Harvard University announced"),
+    ("The molecule consists of", "Scientific research shows"),
+    ("My friend and I", "Our team worked together"),
+    ("This happens because", "If we assume that"),
+    ("Let's create something", "The artist painted a")
+)
+
+_NUM_FEATURE_GROUPS = len(_FEATURE_DESCRIPTIONS)
+
+def _text_digest(text: str, layer: int, digest_size: int) -> bytes:
+    """blake2b digest of (layer, text); keys the encode cache and seeds its RNG"""
+    return hashlib.blake2b(f"{layer}|{text}".encode(), digest_size=digest_size).digest()
+
+@lru_cache(maxsize=None)  # the whole feature space fits
+def _feature_info(feature_id: int) -> Dict[str, Any]:
+    """
+    Simulated feature details, seeded by feature id so they are stable across calls
+    The returned dict is shared between callers and must not be mutated
+    """
+    rng = np.random.default_rng(feature_id)
+    group = feature_id % _NUM_FEATURE_GROUPS
+    return {
+        'feature_id': feature_id,
+        'description': _FEATURE_DESCRIPTIONS[group],
+        'activation_frequency': rng.beta(2, 8),  # Most features are rare
+        'top_tokens': _TOP_TOKENS[group],
+        'example_prompts': _EXAMPLE_PROMPTS[group],
+        'research_notes': f"Feature {feature_id} identified in SAE decomposition research",
+        'interpretability_score': rng.beta(6, 3)  # Generally interpretable
+    }
+
+@lru_cache(maxsize=None)
+def _feature_info_json(feature_id: int) -> bytes:
+    """Pre-serialized _feature_info, served as-is by /sae/feature/<id>"""
+    return orjson.dumps(_feature_info(feature_id), option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _sparse_topk(activations: np.ndarray, k: int) -> np.ndarray:
+    """Top-k values per row, strongest first"""
+    top_vals = np.partition(activations, activations.shape[1] - k, axis=1)[:, -k:]
+    return np.sort(top_vals, axis=1)[:, ::-1]
+
+class TokenFeatures(NamedTuple):
+    """Top active features of an encoded text, one entry per (token, feature) pair"""
+    positions: np.ndarray      # token position of each entry
+    feature_ids: np.ndarray
+    activations: np.ndarray
+    confidences: np.ndarray
+    active_counts: np.ndarray  # number of active features per token
+
 class MockSAEInference:
     """
     Mock SAE inference engine that simulates real SAE behavior
@@ -27,6 +123,7 @@ class MockSAEInference:
     def __init__(self):
         self.feature_dimension = 16384  # Typical SAE feature dimension
         self.vocabulary_size = 50257    # GPT tokenizer vocab size
+        self.rng = np.random.default_rng()  # for uncached endpoints such as search
         
     def encode_text(self, text: str, layer: int = 12) -> Dict[str, Any]:
         """
@@ -37,114 +134,189 @@ class MockSAEInference:
         tokens = text.split()  # Simplified tokenization
         num_tokens = len(tokens)
         
-        # Simulate realistic feature activations (sparse)
-        activations = np.random.exponential(0.1, (num_tokens, self.feature_dimension))
-        activations[activations < 0.5] = 0  # Sparsity threshold
-        
-        # Get top active features per token
-        top_features = []
-        for i, token in enumerate(tokens):
-            token_activations = activations[i]
-            active_indices = np.where(token_activations > 0)[0]
-            
-            if len(active_indices) > 0:
-                # Sort by activation strength
-                sorted_indices = active_indices[np.argsort(token_activations[active_indices])[::-1]]
-                top_5 = sorted_indices[:5]
-                
-                token_features = []
-                for feat_idx in top_5:
-                    token_features.append({
-                        'feature_id': int(feat_idx),
-                        'activation': float(token_activations[feat_idx]),
-                        'description': self._get_feature_description(feat_idx),
-                        'confidence': float(np.random.beta(8, 2))  # High confidence simulation
-                    })
-                
-                top_features.append({
-                    'token': token,
-                    'position': i,
-                    'features': token_features
-                })
+        # Seeded from the input so identical requests encode identically
+        rng = np.random.default_rng(int.from_bytes(_text_digest(text, layer, 8), 'little'))
+        features = self.encode_tokens(num_tokens, rng)
+        total_features = features.active_counts.sum()
         
         return {
             'text': text,
             'layer': layer,
             'model': 'claude-3-sonnet-sae',
-            'total_features': int(np.sum(activations > 0)),
-            'sparsity': float(np.mean(activations > 0)),
-            'token_features': top_features,
+            'total_features': total_features,
+            'sparsity': total_features / (num_tokens * self.feature_dimension),
+            'token_features': self._token_feature_records(tokens, features),
             'metadata': {
                 'feature_dimension': self.feature_dimension,
-                'inference_time_ms': np.random.randint(50, 200),
+                'inference_time_ms': rng.integers(50, 200),
                 'sae_version': 'v2.1',
                 'research_source': 'Anthropic SAE Research 2024'
             }
         }
     
+    def encode_tokens(self, num_tokens: int, rng: np.random.Generator, top_k: int = 5) -> TokenFeatures:
+        """
+        Simulate SAE feature activations for num_tokens tokens, drawing from rng
+        Returns the top_k active features per token as parallel columns
+        """
+        # Simulate realistic feature activations (sparse). Only the features
+        # that clear the 0.5 threshold are drawn: the active count per token is
+        # Poisson with the survival rate of a 0.1-scale exponential above 0.5,
+        # and magnitudes come from the exponential truncated at 0.5.
+        n_active = rng.poisson(self.feature_dimension * np.exp(-0.5 / 0.1), size=num_tokens)
+        
+        # Pad every token's active magnitudes into one float32 (num_tokens, width)
+        # block; slots past a token's active count stay at zero.
+        width = max(int(n_active.max(initial=0)), top_k)
+        activations = rng.standard_exponential((num_tokens, width), dtype=np.float32)
+        activations *= np.float32(0.1)
+        activations += np.float32(0.5)
+        inactive = np.arange(width) >= n_active[:, None]
+        activations[inactive] = 0
+        
+        # Top active features for all tokens at once
+        top_vals = _sparse_topk(activations, top_k)
+        
+        # Magnitudes are independent of feature ids, so the features behind
+        # the top activations are just distinct uniform draws per token
+        top_idx = self._sample_feature_ids(num_tokens, top_k, rng)
+        confidences = rng.beta(8, 2, size=(num_tokens, top_k))  # High confidence simulation
+        
+        # The j-th strongest slot is active iff j < n_active, so the padding
+        # mask doubles as the top-k mask. Flatten row-major so each token's
+        # features stay contiguous and strongest first.
+        active = ~inactive[:, :top_k]
+        return TokenFeatures(
+            positions=np.nonzero(active)[0],
+            feature_ids=top_idx[active],
+            activations=top_vals[active],
+            confidences=confidences[active],
+            active_counts=n_active
+        )
+    
+    def _token_feature_records(self, tokens: List[str], features: TokenFeatures) -> List[Dict[str, Any]]:
+        """Materialize the per-token feature dicts of the encode response"""
+        groups = (features.feature_ids % _NUM_FEATURE_GROUPS).tolist()
+        descriptions = [_FEATURE_DESCRIPTIONS[group] for group in groups]
+        records: List[Dict[str, Any]] = []
+        for position, feat_idx, activation, description, confidence in zip(
+            features.positions.tolist(),
+            features.feature_ids.tolist(),
+            features.activations.tolist(),
+            descriptions,
+            features.confidences.tolist()
+        ):
+            if not records or records[-1]['position'] != position:
+                records.append({'token': tokens[position], 'position': position, 'features': []})
+            records[-1]['features'].append({
+                'feature_id': feat_idx,
+                'activation': activation,
+                'description': description,
+                'confidence': confidence
+            })
+        return records
+    
+    def _sample_feature_ids(self, num_rows: int, k: int, rng: np.random.Generator) -> np.ndarray:
+        """Draw k distinct feature ids per row, redrawing the rare rows with collisions"""
+        ids = rng.integers(0, self.feature_dimension, size=(num_rows, k))
+        while True:
+            ordered = np.sort(ids, axis=1)
+            collided = (ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+            if not collided.any():
+                return ids
+            ids[collided] = rng.integers(0, self.feature_dimension, size=(int(collided.sum()), k))
+    
     def get_feature_info(self, feature_id: int) -> Dict[str, Any]:
         """Get detailed information about a specific SAE feature"""
-        return {
-            'feature_id': feature_id,
-            'description': self._get_feature_description(feature_id),
-            'activation_frequency': float(np.random.beta(2, 8)),  # Most features are rare
-            'top_tokens': self._get_top_tokens(feature_id),
-            'example_prompts': self._get_example_prompts(feature_id),
-            'research_notes': f"Feature {feature_id} identified in SAE decomposition research",
-            'interpretability_score': float(np.random.beta(6, 3))  # Generally interpretable
-        }
+        return dict(_feature_info(feature_id))
     
-    def _get_feature_description(self, feature_id: int) -> str:
-        """Generate realistic feature descriptions"""
-        descriptions = [
-            "Emotional expression (positive sentiment)",
-            "Geographic locations and place names", 
-            "Mathematical operations and numbers",
-            "Past tense verbs and temporal expressions",
-            "Question formation and interrogative patterns",
-            "Proper nouns and named entities",
-            "Scientific terminology and concepts",
-            "Social interaction and relationship terms",
-            "Abstract reasoning and logic patterns",
-            "Creative and artistic language"
-        ]
-        return descriptions[feature_id % len(descriptions)]
-    
-    def _get_top_tokens(self, feature_id: int) -> List[str]:
-        """Get tokens that most activate this feature"""
-        token_sets = [
-            ["happy", "joy", "excited", "wonderful", "amazing"],
-            ["Paris", "London", "Tokyo", "mountain", "river"],
-            ["plus", "minus", "equals", "calculate", "number"],
-            ["walked", "went", "happened", "was", "did"],
-            ["what", "how", "when", "where", "why"],
-            ["John", "Mary", "Smith", "Company", "University"],
-            ["molecule", "theory", "experiment", "research", "data"],
-            ["friend", "family", "together", "relationship", "team"],
-            ["because", "therefore", "if", "then", "logic"],
-            ["create", "imagine", "beautiful", "art", "design"]
-        ]
-        return token_sets[feature_id % len(token_sets)]
+    def get_feature_info_json(self, feature_id: int) -> bytes:
+        """Get feature information as pre-serialized JSON"""
+        return _feature_info_json(feature_id)
     
-    def _get_example_prompts(self, feature_id: int) -> List[str]:
-        """Get example prompts that activate this feature"""
-        prompt_sets = [
-            ["I'm feeling great today!", "What a wonderful surprise!"],
-            ["The capital of France is", "Mountains are tall and"],
-            ["2 + 2 equals", "Calculate the sum of"],
-            ["Yesterday I walked to", "The event happened when"],
-            ["What is the meaning of", "How do you solve"],
-            ["Dr. Smith published", "Harvard University announced"],
-            ["The molecule consists of", "Scientific research shows"],
-            ["My friend and I", "Our team worked together"],
-            ["This happens because", "If we assume that"],
-            ["Let's create something", "The artist painted a"]
+    def search_features(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Simulate feature search (in real implementation: vector similarity search)
+        Returns feature info records ordered by relevance
+        """
+        feature_ids = self.rng.integers(0, self.feature_dimension, size=limit).tolist()
+        relevances = self.rng.beta(3, 7, size=limit)  # Most results have low relevance
+        order = np.argsort(-relevances).tolist()
+        relevances = relevances.tolist()
+        
+        return [
+            {**_feature_info(feature_ids[k]), 'relevance_score': relevances[k]}
+            for k in order
         ]
-        return prompt_sets[feature_id % len(prompt_sets)]
 
 # Initialize SAE inference engine
 sae_engine = MockSAEInference()
 
+# Forked workers must not replay the parent's random stream
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: setattr(sae_engine, 'rng', np.random.default_rng()))
+
+# Longest text /sae/encode accepts, in (whitespace) tokens
+MAX_TOKENS = 2048
+
+# Highest layer index /sae/encode accepts
+MAX_LAYER = 255
+
+# Recent /sae/encode responses, keyed by (text, layer) and stored pre-serialized.
+# Bounded by payload bytes per worker process; a MAX_TOKENS response is ~1.5 MB.
+ENCODE_CACHE_BYTES = 64 * 1024 * 1024
+ENCODE_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+_encode_cache: LRUCache = LRUCache(maxsize=ENCODE_CACHE_BYTES, getsizeof=len)
+_encode_cache_lock = threading.Lock()
+_encode_inflight: Dict[bytes, '_EncodeFlight'] = {}
+
+class _EncodeFlight:
+    """An in-progress encode that concurrent requests for the same key wait on"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.payload: Optional[bytes] = None
+        self.error: Optional[BaseException] = None
+
+def _encode_cache_key(text: str, layer: int) -> bytes:
+    return _text_digest(text, layer, 16)
+
+def encode_text_cached(text: str, layer: int) -> bytes:
+    """
+    Serialized encode_text result, served from the response cache when possible
+    Concurrent requests for the same key share a single computation
+    """
+    key = _encode_cache_key(text, layer)
+    with _encode_cache_lock:
+        payload = _encode_cache.get(key)
+        if payload is not None:
+            return payload
+        flight = _encode_inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _encode_inflight[key] = _EncodeFlight()
+    
+    if not leader:
+        # Followers take the leader's result, even when it was too large to cache
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.payload
+    
+    try:
+        flight.payload = orjson.dumps(sae_engine.encode_text(text, layer), option=orjson.OPT_SERIALIZE_NUMPY)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _encode_cache_lock:
+            if flight.payload is not None and len(flight.payload) <= ENCODE_CACHE_MAX_ENTRY_BYTES:
+                _encode_cache[key] = flight.payload
+            if _encode_inflight.get(key) is flight:
+                del _encode_inflight[key]
+        flight.done.set()
+    return flight.payload
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -158,11 +330,21 @@ def sae_encode():
         text = data.get('text', '')
         layer = data.get('layer', 12)
         
-        if not text:
+        tokens = text.split() if isinstance(text, str) else []
+        if not tokens:
             return jsonify({'error': 'Text is required'}), 400
+        if len(tokens) > MAX_TOKENS:
+            return jsonify({'error': f'Text exceeds {MAX_TOKENS} tokens'}), 413
+        try:
+            text.encode('utf-8')
+        except UnicodeEncodeError:  # lone surrogates can be neither hashed nor serialized
+            return jsonify({'error': 'Text must be valid Unicode'}), 400
+        if not isinstance(layer, int) or isinstance(layer, bool):
+            return jsonify({'error': 'Layer must be an integer'}), 400
+        if not 0 <= layer <= MAX_LAYER:
+            return jsonify({'error': f'Layer must be between 0 and {MAX_LAYER}'}), 400
         
-        result = sae_engine.encode_text(text, layer)
-        return jsonify(result)
+        return app.response_class(encode_text_cached(text, layer), mimetype='application/json')
         
     except Exception as e:
         logger.error(f"SAE encoding error: {e}")
@@ -175,8 +357,7 @@ def get_feature(feature_id: int):
         if feature_id < 0 or feature_id >= sae_engine.feature_dimension:
             return jsonify({'error': 'Invalid feature ID'}), 400
         
-        result = sae_engine.get_feature_info(feature_id)
-        return jsonify(result)
+        return app.response_class(sae_engine.get_feature_info_json(feature_id), mimetype='application/json')
         
     except Exception as e:
         logger.error(f"Feature lookup error: {e}")
@@ -187,26 +368,14 @@ def search_features():
     """Search for features by description or concept"""
     try:
         query = request.args.get('query', '')
-        limit = min(int(request.args.get('limit', 20)), 100)
+        limit = max(0, min(int(request.args.get('limit', 20)), 100))
         
         if not query:
             return jsonify({'error': 'Query is required'}), 400
         
-        # Simulate feature search (in real implementation: vector similarity search)
-        results = []
-        for i in range(limit):
-            feature_id = np.random.randint(0, sae_engine.feature_dimension)
-            feature_info = sae_engine.get_feature_info(feature_id)
-            
-            # Simple relevance simulation
-            relevance = np.random.beta(3, 7)  # Most results have low relevance
-            feature_info['relevance_score'] = float(relevance)
-            results.append(feature_info)
-        
-        # Sort by relevance
-        results.sort(key=lambda x: x['relevance_score'], reverse=True)
-        
-        return jsonify({
+        results = sae_engine.search_features(query, limit)
+        
+        return ojsonify({
             'query': query,
             'total_results': len(results),
             'features': results
@@ -224,6 +393,7 @@ if __name__ == '__main__':
     print("   • GET /sae/feature/<id> - Get feature details")
     print("   • GET /sae/search?query=<text> - Search features")
     print("   • GET /health - Health check")
+    print("   (development server; use `gunicorn sae_inference_service:app` in production)")
     print()
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
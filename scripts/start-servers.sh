@@ -13,6 +13,7 @@ echo "Cleaning up existing processes..."
 pkill -f "node.*server.js" 2>/dev/null || true
 pkill -f "vite" 2>/dev/null || true
 pkill -f "python.*sae_inference_service.py" 2>/dev/null || true
+pkill -f "gunicorn.*sae_inference_service" 2>/dev/null || true
 
 # Wait a moment for processes to clean up
 sleep 2
@@ -21,7 +22,11 @@ sleep 2
 if command -v python3 &> /dev/null && [ -f "scripts/sae_inference_service.py" ]; then
     echo "Starting Python SAE inference service on port 5000..."
     cd scripts
-    python3 sae_inference_service.py &
+    if command -v gunicorn &> /dev/null; then
+        gunicorn sae_inference_service:app &
+    else
+        python3 sae_inference_service.py &
+    fi
     SAE_PID=$!
     cd ..
     sleep 2